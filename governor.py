@@ -0,0 +1,269 @@
+"""
+PDFMute resource governor.
+
+Runs a batch of PDFs within a memory budget and a CPU budget. From the page
+sizes of each file and the per-process peak memory measured so far, it picks
+the render DPI, whether (and how finely) to render pages in bands, and how
+many files to process at once. The plan is re-computed after every file, so
+it tightens when pages turn out to be more expensive than estimated and
+opens up again when they are cheaper.
+
+Each worker process handles one file (and so one page) at a time: MuPDF
+documents cannot be shared between threads, so page and file concurrency are
+the same number here.
+
+Peak memory is read from resource.getrusage on POSIX, or from the optional
+psutil package elsewhere. Without either, the built-in per-pixel estimate is
+used throughout.
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pymupdf as fitz  # PyMuPDF
+
+from main import get_muter, warm_up
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_memory():
+    """
+    Returns this process' peak resident memory in bytes, or None if unknown.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # macOS reports bytes, Linux KiB
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def current_memory():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return peak_memory()
+
+
+class ResourceGovernor:
+    """
+    Chooses (dpi, tile_height, workers) for a page size within the budgets and
+    learns the real bytes-per-pixel cost from the peaks reported by workers.
+    """
+
+    # Render + cleaned copy + lookup indices + mask + encoder buffers, per pixel
+    DEFAULT_BYTES_PER_PIXEL = 20
+    # Interpreter, PyMuPDF, numpy and the compiled lookup table, per worker
+    DEFAULT_BASE_BYTES = 150 * 1024 * 1024
+    MIN_TILE_HEIGHT = 256
+    DPI_STEP = 25
+
+    def __init__(self, memory_budget, cpu_budget=None, max_dpi=300, min_dpi=150):
+        self.memory_budget = memory_budget
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.max_dpi = max_dpi
+        self.min_dpi = min(min_dpi, max_dpi)
+        self.bytes_per_pixel = self.DEFAULT_BYTES_PER_PIXEL
+        self.base_bytes = self.DEFAULT_BASE_BYTES
+        self.measured = False
+        self.lock = threading.Lock()
+
+    def worker_bytes(self, pixels):
+        return self.base_bytes + self.bytes_per_pixel * pixels
+
+    def plan(self, page_width, page_height, files_left=None):
+        """
+        Returns {'dpi', 'tile_height', 'workers'} for pages of the given size in points.
+        Prefers, in order: more workers, no tiling, then higher DPI. DPI is only
+        lowered when even the smallest bands do not fit a single worker.
+        """
+        with self.lock:
+            max_workers = min(self.cpu_budget, files_left or self.cpu_budget)
+            for dpi in range(self.max_dpi, self.min_dpi - 1, -self.DPI_STEP):
+                width_px = page_width * dpi / 72
+                height_px = page_height * dpi / 72
+                for workers in range(max_workers, 0, -1):
+                    per_worker = self.memory_budget / workers
+                    if self.worker_bytes(width_px * height_px) <= per_worker:
+                        return {'dpi': dpi, 'tile_height': None, 'workers': workers}
+                    tile_height = int((per_worker - self.base_bytes) / (self.bytes_per_pixel * width_px))
+                    if tile_height >= self.MIN_TILE_HEIGHT:
+                        return {'dpi': dpi, 'tile_height': tile_height, 'workers': workers}
+
+        # Nothing fits: run as lean as possible rather than not at all
+        return {'dpi': self.min_dpi, 'tile_height': self.MIN_TILE_HEIGHT, 'workers': 1}
+
+    def record(self, pixels, base_bytes, peak_bytes):
+        """
+        Feeds back one worker's measurement: its baseline memory, its peak, and
+        the largest band or page (in pixels) it has processed so far.
+        """
+        if not (pixels and base_bytes and peak_bytes) or peak_bytes <= base_bytes:
+            return
+        with self.lock:
+            measured = (peak_bytes - base_bytes) / pixels
+            if not self.measured:
+                # First real numbers replace the defaults
+                self.bytes_per_pixel, self.base_bytes = measured, base_bytes
+                self.measured = True
+            else:
+                # Move halfway towards the measurement, but never below what a worker really used
+                self.bytes_per_pixel = max(measured, (self.bytes_per_pixel + measured) / 2)
+                self.base_bytes = max(self.base_bytes, base_bytes)
+
+
+# ------------- WORKER PROCESS ------------- #
+_base_memory = None
+_max_pixels = 0
+_page_events = None
+
+
+def _init_worker(engines, page_events):
+    global _base_memory, _page_events
+    warm_up(engines)
+    _base_memory = current_memory()
+    _page_events = page_events
+
+
+def _run_file(input_pdf, output_pdf, engine, color, dpi, min_dpi, tile_height, muter_options):
+    global _max_pixels
+    started = time.perf_counter()
+    pages = []
+
+    def on_progress(percent):
+        pages.append(percent)
+        if _page_events is not None:
+            _page_events.put((input_pdf, len(pages), percent))
+
+    # The planned DPI is a cap: pages that need less detail are rendered lower
+    muter = get_muter(engine, color, dpi='auto', min_dpi=min_dpi, max_dpi=dpi, tile_height=tile_height,
+                      **muter_options)
+    muter.process_file(input_pdf, output_pdf, on_progress)
+    # Peaks only ever grow, so pair them with the largest band rendered in this process.
+    # Rendered, not planned: the planned DPI is only a cap.
+    _max_pixels = max(_max_pixels, muter.largest_band)
+    return {
+        'pixels': _max_pixels,
+        'base_bytes': _base_memory,
+        'peak_bytes': peak_memory(),
+        'pages': len(pages),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def _largest_page(input_pdf):
+    doc = fitz.open(input_pdf)
+    sizes = [(page.rect.width, page.rect.height) for page in doc]
+    doc.close()
+    return max(sizes, key=lambda size: size[0] * size[1], default=(612, 792))
+
+
+def _start_pool(governor, engine, page_events):
+    return ProcessPoolExecutor(max_workers=governor.cpu_budget, initializer=_init_worker,
+                               initargs=((engine,), page_events), mp_context=multiprocessing.get_context('spawn'))
+
+
+def run_batch(files, memory_budget, cpu_budget=None, engine='cpu', color='white',
+              max_dpi=300, min_dpi=150, on_done=None, on_page=None, **muter_options):
+    """
+    Cleans [(input_pdf, output_pdf), ...] under the given budgets.
+    Other keyword arguments (output, palette, image_format, ...) go to the Muter.
+    on_done(input_pdf, output_pdf, plan, error, outcome) is called as each file
+    finishes; outcome holds its page count, run time and memory figures. Files
+    that cannot be opened are reported with plan None and the open error.
+    on_page(input_pdf, page_number, percent) is called after every page.
+    Returns the governor, whose final estimates describe what the batch cost.
+
+    A file is started only while its plan allows that many files in flight and
+    its estimated bytes fit next to those reserved by the running files and the
+    baseline of idle worker processes. Worker processes live as long as their
+    pool, so when idle ones are what keeps a file out, the pool is replaced:
+    the old one exits as its running files finish.
+    """
+    governor = ResourceGovernor(memory_budget, cpu_budget, max_dpi=max_dpi, min_dpi=min_dpi)
+    pending = list(files)
+    running = {}     # future -> (input_pdf, output_pdf, plan, reserved bytes, pool)
+    page_sizes = {}
+    page_events = None
+    if on_page:
+        page_events = multiprocessing.get_context('spawn').Queue()
+
+        def forward_events():
+            for event in iter(page_events.get, None):
+                on_page(*event)
+
+        forwarder = threading.Thread(target=forward_events, daemon=True)
+        forwarder.start()
+    pools = [_start_pool(governor, engine, page_events)]
+    live_workers = 0  # Processes started by the current pool; it starts one per submit without an idle one
+
+    try:
+        while pending or running:
+            # Start files while the current plan and the memory left allow
+            while pending:
+                input_pdf, output_pdf = pending[0]
+                if input_pdf not in page_sizes:
+                    try:
+                        page_sizes[input_pdf] = _largest_page(input_pdf)
+                    except Exception as e:
+                        pending.pop(0)
+                        if on_done:
+                            on_done(input_pdf, output_pdf, None, e, None)
+                        continue
+                width, height = page_sizes[input_pdf]
+                plan = governor.plan(width, height, files_left=len(pending) + len(running))
+                width_px = int(width * plan['dpi'] / 72)
+                rows = plan['tile_height'] or int(height * plan['dpi'] / 72)
+                cost = governor.worker_bytes(width_px * rows)
+
+                reserved = sum(entry[3] for entry in running.values())
+                busy = sum(1 for entry in running.values() if entry[4] is pools[-1])
+                # An idle worker would take this file; the others keep their baseline
+                idle_others = max(live_workers - busy - 1, 0)
+                fits = reserved + cost + idle_others * governor.base_bytes <= memory_budget
+                if not fits and idle_others and reserved + cost <= memory_budget:
+                    pools[-1].shutdown(wait=False)
+                    pools.append(_start_pool(governor, engine, page_events))
+                    live_workers = 0
+                    continue
+                if running and (len(running) >= plan['workers'] or not fits):
+                    break
+
+                pending.pop(0)
+                if live_workers <= busy:
+                    live_workers += 1
+                future = pools[-1].submit(_run_file, input_pdf, output_pdf, engine, color, plan['dpi'],
+                                          governor.min_dpi, plan['tile_height'], muter_options)
+                running[future] = (input_pdf, output_pdf, plan, cost, pools[-1])
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                input_pdf, output_pdf, plan = running.pop(future)[:3]
+                error = future.exception()
+                outcome = None
+                if error is None:
+                    outcome = future.result()
+                    governor.record(outcome['pixels'], outcome['base_bytes'], outcome['peak_bytes'])
+                if on_done:
+                    on_done(input_pdf, output_pdf, plan, error, outcome)
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=True)
+        if page_events is not None:
+            page_events.put(None)
+            forwarder.join()
+
+    return governor
@@ -1,80 +1,1017 @@
-import fitz  # PyMuPDF
+import pymupdf as fitz  # PyMuPDF
 from PIL import Image
+import numpy as np
+import argparse
+import functools
+import hashlib
 import io  # For handling byte streams
+import json
+import multiprocessing
 import os  # For handling file directories
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def remove_red_pixels(input_pdf, output_pdf):
-    doc = fitz.open(input_pdf)
-    new_doc = fitz.Document()
-
-    target_colors = [
-        ((224, 202, 202), 5),
-        ((218, 203, 204), 5),
-        ((229, 220, 220), 5),
-        ((230, 212, 220), 5),
-        ((215, 190, 197), 5),
-        ((254, 251, 249), 5),
-        ((197, 193, 194), 5),
-        ((197, 195, 196), 5),
-        ((198, 194, 195), 5),
-        ((200, 192, 195), 5),
-        ((200, 195, 195), 5),
-        ((200, 196, 195), 5),
-        ((201, 193, 194), 5),
-        ((202, 185, 187), 5),
-        ((203, 199, 198), 5),
-        ((205, 203, 204), 5),
-    ]
-
-    for page in doc:
-        pix = page.get_pixmap(dpi=300)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        pixels = img.load()
-
-        # First pass - convert intense red pixels and target colors
-        for y in range(img.height):
-            for x in range(img.width):
-                r, g, b = pixels[x, y]
-                if r > 150 and r > g * 1.2 and r > b * 1.5 and (r + g + b) > 100:
-                    pixels[x, y] = (255, 255, 255)
+# Pre-defined target colors (e.g. pink-ish or near red) with delta tolerance
+TARGET_COLORS = [
+    ((224, 202, 202), 5),
+    ((218, 203, 204), 5),
+    ((229, 220, 220), 5),
+    ((230, 212, 220), 5),
+    ((215, 190, 197), 5),
+    ((254, 251, 249), 5),
+    ((197, 193, 194), 5),
+    ((197, 195, 196), 5),
+    ((198, 194, 195), 5),
+    ((200, 192, 195), 5),
+    ((200, 195, 195), 5),
+    ((200, 196, 195), 5),
+    ((201, 193, 194), 5),
+    ((202, 185, 187), 5),
+    ((203, 199, 198), 5),
+    ((205, 203, 204), 5),
+]
+
+# Target colors less than this much redder than their green and blue are near-grey.
+# Anti-aliased edges of black text hit those too, so they are not treated as ink.
+INK_MIN_REDNESS = 10
+
+
+def _is_grey_target(ccheck):
+    return ccheck[0] - max(ccheck[1], ccheck[2]) < INK_MIN_REDNESS
+
+
+# Torch is imported lazily so the CPU engine does not pay for it
+_torch_device = None
+
+
+def get_torch_device():
+    """
+    Returns the torch device used by the GPU engine, creating it on first use.
+    """
+    global _torch_device
+    if _torch_device is None:
+        from torch import device
+        from torch.cuda import is_available as cuda_is_available
+        _torch_device = device("cuda" if cuda_is_available() else "cpu")
+    return _torch_device
+
+
+@functools.lru_cache(maxsize=None)
+def load_palette(path):
+    """
+    Loads a palette saved by palette.py, once per process.
+    """
+    from palette import Palette
+    return Palette.load(path)
+
+
+# ------------- RULE COMPILATION ------------- #
+@functools.lru_cache(maxsize=None)
+def compile_rules(color='white', ink_only=False):
+    """
+    Evaluates the CPU red-removal rules once for every 24-bit RGB value.
+    Returns a boolean lookup table indexed by (r << 16) | (g << 8) | b, so
+    classifying a pixel costs one table read instead of a palette scan.
+    With ink_only, the near-grey target colors are left out: the table then
+    finds red ink only, not the edges of black text.
+    """
+    lut = np.zeros(1 << 24, dtype=bool)
+    g, b = np.meshgrid(np.arange(256, dtype=np.float64), np.arange(256, dtype=np.float64), indexing='ij')
+    g, b = g.ravel(), b.ravel()
+
+    for r in range(256):
+        # Pass 1: Intense red + target colors
+        mask = (r > 150) & (r > g * 1.2) & (r > b * 1.5) & ((r + g + b) > 100)
+        for ccheck, delta in TARGET_COLORS:
+            if ink_only and _is_grey_target(ccheck):
+                continue
+            if abs(r - ccheck[0]) <= delta:
+                mask |= (np.abs(g - ccheck[1]) <= delta) & (np.abs(b - ccheck[2]) <= delta)
+
+        # Pass 2: Leftover reds if color is white (pass 1 output is never reddish)
+        if color == 'white' and r > 180:
+            mask |= (r > g) & (r > b)
+
+        lut[r << 16:(r + 1) << 16] = mask
+    return lut
+
+
+# Combined rule tables, one per (color, palette digest) however many Muters use them
+_palette_rules = {}
+_palette_tensors = {}
+
+
+def compile_palette_rules(color, palette, ink_only=False):
+    """
+    Returns compile_rules(color, ink_only) extended with a learned palette's colors.
+    """
+    key = (color, palette.digest, ink_only)
+    if key not in _palette_rules:
+        _palette_rules[key] = compile_rules(color, ink_only) | palette.lut
+    return _palette_rules[key]
+
+
+def palette_tensor(palette):
+    """
+    Returns a learned palette's lookup table on the torch device.
+    """
+    if palette.digest not in _palette_tensors:
+        from torch import from_numpy
+        _palette_tensors[palette.digest] = from_numpy(palette.lut).to(get_torch_device())
+    return _palette_tensors[palette.digest]
+
+
+def changed_regions(mask, block=32):
+    """
+    Groups the changed pixels of a page into a few rectangles for overlay output.
+    The mask is reduced to block x block cells, horizontal runs of changed cells
+    are found per row, and identical runs on consecutive rows are merged.
+    Returns a list of (x0, y0, x1, y1) pixel rectangles.
+    """
+    height, width = mask.shape
+    rows, cols = -(-height // block), -(-width // block)
+    padded = np.zeros((rows * block, cols * block), dtype=bool)
+    padded[:height, :width] = mask
+    cells = padded.reshape(rows, block, cols, block).any(axis=(1, 3))
+
+    regions = []
+    open_runs = {}  # (first col, end col) -> first row
+    for row in range(rows + 1):
+        runs = set()
+        if row < rows:
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], cells[row].astype(np.int8), [0]))))
+            runs = set(zip(edges[::2].tolist(), edges[1::2].tolist()))
+        for run in [run for run in open_runs if run not in runs]:
+            first_row = open_runs.pop(run)
+            regions.append((run[0] * block, first_row * block,
+                            min(run[1] * block, width), min(row * block, height)))
+        for run in runs:
+            open_runs.setdefault(run, row)
+    return regions
+
+
+# ------------- RENDER RESOLUTION ------------- #
+def choose_dpi(page, min_dpi=100, max_dpi=300, vector_dpi=200):
+    """
+    Picks the lowest render DPI that keeps the detail of a page.
+    Scanned pages (an image covering most of the page) use the scan's own
+    resolution; otherwise the sharpest sizable image sets the floor and any
+    text or vector drawing raises it to vector_dpi. Clamped to [min_dpi, max_dpi].
+    """
+    page_area = abs(page.rect)
+    image_dpi = 0
+    scanned = False
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info['bbox'])
+        if bbox.is_empty or abs(bbox) < page_area * 0.01:
+            continue  # Logos and bullets don't need to be kept pixel-exact
+        # Area based, so rotated placements give the same answer
+        dpi = 72 * ((info['width'] * info['height']) / abs(bbox)) ** 0.5
+        image_dpi = max(image_dpi, dpi)
+        scanned = scanned or abs(bbox) >= page_area * 0.9
+
+    # Text over a full-page scan is normally an invisible OCR layer
+    if not scanned and (page.get_text("words") or page.get_drawings()):
+        image_dpi = max(image_dpi, vector_dpi)
+
+    return int(min(max(round(image_dpi), min_dpi), max_dpi))
+
+
+# ------------- PAGE DEDUPLICATION ------------- #
+_REFERENCE = re.compile(r'\b(\d+) (\d+) R\b')
+
+
+def _object_digest(doc, xref, memo, active):
+    """
+    Hashes a PDF object by content: its source with every reference replaced
+    by the referenced object's own digest, plus its raw stream data if any.
+    """
+    if xref in memo:
+        return memo[xref]
+    if xref in active:
+        return 'cycle'
+    if not 0 < xref < doc.xref_length():
+        return 'null'
+    active.add(xref)
+    digest = hashlib.sha256()
+    digest.update(_normalized_source(doc, doc.xref_object(xref, compressed=True), memo, active).encode())
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    active.discard(xref)
+    memo[xref] = digest.hexdigest()
+    return memo[xref]
+
+
+def _normalized_source(doc, source, memo, active):
+    return _REFERENCE.sub(lambda match: _object_digest(doc, int(match.group(1)), memo, active), source)
+
+
+def _inherited_key(doc, xref, key):
+    """
+    Returns the source of a page key, following /Parent like Resources inheritance does.
+    """
+    while True:
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != 'null':
+            return value
+        kind, parent = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref':
+            return ''
+        xref = int(parent.split()[0])
+
+
+def page_fingerprint(page):
+    """
+    Hashes everything that determines how a page renders: its size and
+    rotation, content stream, transparency group and everything reachable
+    from its /Resources (images, fonts, form XObjects, graphics states, color
+    spaces, patterns, shadings...). Referenced objects are hashed by content,
+    so the same page in two different PDFs gets the same hash.
+    Returns None for pages with annotations or form fields (whose filled-in
+    values are not part of the page), which are not cached.
+    """
+    if page.first_annot is not None or page.first_widget is not None:
+        return None
+
+    doc = page.parent
+    memo, active = {}, set()
+    digest = hashlib.sha256()
+    digest.update(repr((tuple(page.rect), tuple(page.cropbox), page.rotation)).encode())
+    digest.update(page.read_contents())
+    resources = _inherited_key(doc, page.xref, 'Resources')
+    group = doc.xref_get_key(page.xref, 'Group')[1]
+    for source in (resources, group):
+        digest.update(_normalized_source(doc, source, memo, active).encode() + b'\0')
+    return digest.hexdigest()
+
+
+class PageCache:
+    """
+    LRU cache of encoded cleaned pages keyed by page fingerprint + Muter
+    settings. Share one instance across a batch so repeated cover,
+    instruction and formula-sheet pages are cleaned only once.
+    """
+
+    # Counted per entry on top of its image bytes, so records without images
+    # (fill output, unchanged overlay pages) still take up room and get evicted
+    ENTRY_OVERHEAD = 1024
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, page, settings):
+        fingerprint = page_fingerprint(page)
+        return (fingerprint,) + tuple(settings) if fingerprint else None
+
+    def get(self, key):
+        with self.lock:
+            record = self.entries.get(key)
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return record
+
+    def record_size(self, record):
+        return self.ENTRY_OVERHEAD + sum(len(image) for _, image, _ in record[2] if image)
+
+    def put(self, key, record):
+        record_size = self.record_size(record)
+        if record_size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = record
+            self.size += record_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.record_size(evicted)
+
+
+# ------------- OUTPUT ------------- #
+class PdfWriter:
+    """
+    Builds an output PDF without holding all of it in memory.
+
+    Pages are added to `doc`; after every flush_every pages they are appended
+    to a temporary file next to output_pdf with an incremental save, and the
+    document is reopened from that file so their image data leaves memory.
+    close() rewrites the file once with garbage collection (which also merges
+    duplicate images and fonts) and deflate, then renames it over output_pdf,
+    so readers never see a half-written PDF. Extra keyword arguments are passed
+    to that final save (e.g. use_objstms on PyMuPDF versions that support it).
+
+    With output_pdf=None the writer is purely in memory and never flushes.
+    """
+
+    SAVE_OPTIONS = {'garbage': 4, 'deflate': True}
+
+    def __init__(self, output_pdf, flush_every=16, **save_options):
+        self.output_pdf = output_pdf
+        self.flush_every = flush_every
+        self.save_options = dict(self.SAVE_OPTIONS, **save_options)
+        self.doc = fitz.Document()
+        self.unsaved_pages = 0
+        self.temp_path = None
+        if output_pdf is not None:
+            target_dir = os.path.dirname(os.path.abspath(output_pdf))
+            self.temp_path = os.path.join(target_dir, f".{os.path.basename(output_pdf)}.{uuid.uuid4().hex}.tmp")
+
+    def page_added(self):
+        self.unsaved_pages += 1
+        if self.output_pdf is not None and self.unsaved_pages >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.unsaved_pages:
+            return
+        if os.path.exists(self.temp_path):
+            self.doc.saveIncr()
+        else:
+            self.doc.save(self.temp_path, deflate=True)
+        self.doc.close()
+        self.doc = fitz.open(self.temp_path)
+        self.unsaved_pages = 0
+
+    def close(self):
+        self.flush()
+        final_path = self.temp_path + '.final'
+        try:
+            self.doc.save(final_path, **self.save_options)
+            self.doc.close()
+            os.replace(final_path, self.output_pdf)
+        finally:
+            for path in (self.temp_path, final_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def abort(self):
+        # close() may have failed after closing the document (e.g. in os.replace)
+        if not self.doc.is_closed:
+            self.doc.close()
+        if self.temp_path is not None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class Muter:
+    """
+    Reusable red remover: the rule set (CPU lookup table) or torch device is
+    prepared once in the constructor and shared by every document processed.
+
+    Works on paths (process_file), in-memory PDFs (process_bytes),
+    open documents (process_document) or page by page (iter_pages).
+
+    Output modes:
+      'raster'  - every page is replaced by one full-page JPEG (the original behavior),
+                  on a page of the original's size in points.
+      'overlay' - the original pages are kept (size, text layer, vectors) and only
+                  the regions with changed pixels are covered by cleaned PNG patches.
+                  Annotations and form fields are flattened into the page, and red
+                  text under the patches is removed from the text layer. Red marks in
+                  images and vector drawings are only covered, not deleted, so they
+                  can still be extracted; use 'raster' when that matters.
+      'fill'    - like 'overlay', but the regions are covered with plain rectangles
+                  in the replacement color. Cheapest, but also hides any non-red
+                  content inside a region.
+
+    Pass a PageCache to reuse cleaned pages that repeat within or across documents.
+    Pass a palette.Palette (or the path of a saved one) to also remove ink colors
+    learned from sample pages. Raster pages are stored as image_format
+    ('JPEG' at jpeg_quality, or lossless 'PNG').
+    With tile_height (pixel rows), pages are rendered and cleaned in horizontal
+    bands, which caps memory per page at the cost of one image per band.
+    With dpi='auto', each page is rendered at choose_dpi(page, min_dpi, max_dpi).
+    """
+
+    # Rows per lookup band when applying a palette on the GPU engine
+    PALETTE_BAND_ROWS = 256
+
+    def __init__(self, engine='cpu', color='white', dpi=300, output='raster', cache=None, tile_height=None,
+                 min_dpi=100, max_dpi=300, palette=None, image_format='JPEG', jpeg_quality=100):
+        if engine not in ('cpu', 'gpu'):
+            raise ValueError(f"Unknown engine: {engine}")
+        if color not in ('white', 'black'):
+            raise ValueError(f"Unknown color: {color}")
+        if output not in ('raster', 'overlay', 'fill'):
+            raise ValueError(f"Unknown output mode: {output}")
+        if image_format not in ('JPEG', 'PNG'):
+            raise ValueError(f"Unknown image format: {image_format}")
+        if isinstance(palette, str):
+            palette = load_palette(palette)
+        self.engine = engine
+        self.color = color
+        self.dpi = dpi
+        self.min_dpi = min_dpi
+        self.max_dpi = max_dpi
+        self.output = output
+        self.cache = cache
+        self.tile_height = tile_height
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        # Everything besides the page itself that affects the output (cache keys)
+        self.settings = (engine, color, dpi, output, tile_height, image_format, jpeg_quality)
+        if dpi == 'auto':
+            self.settings += (min_dpi, max_dpi)
+        if palette is not None:
+            self.settings += (palette.digest,)
+        self.colorrgb = (255, 255, 255) if color == 'white' else (0, 0, 0)
+        self.text_colors = {}  # sRGB text color -> classified as red
+        self.largest_band = 0  # Pixels of the largest page or band rendered so far
+
+        if engine == 'cpu':
+            self.lut = compile_rules(color) if palette is None else compile_palette_rules(color, palette)
+            # Overlay and fill regions follow the red ink only (see compile_rules)
+            self.ink_lut = self.lut
+            if output != 'raster':
+                self.ink_lut = (compile_rules(color, ink_only=True) if palette is None
+                                else compile_palette_rules(color, palette, ink_only=True))
+        else:
+            from torch import tensor, float32
+            self.device = get_torch_device()
+            self.color_tensor = tensor(self.colorrgb, device=self.device, dtype=float32).view(3, 1)
+            self.palette_lut = palette_tensor(palette) if palette is not None else None
+
+    # ------------------- PIXELS ------------------- #
+    def _clean_array_cpu(self, arr):
+        packed = (arr[..., 0].astype(np.uint32) << 16) | (arr[..., 1].astype(np.uint32) << 8) | arr[..., 2]
+        mask = self.lut[packed]
+        ink = mask if self.ink_lut is self.lut else self.ink_lut[packed]
+        arr[mask] = self.colorrgb
+        return arr, mask, ink
+
+    def _clean_array_gpu(self, arr):
+        from torch import cat, from_numpy
+
+        # Convert to tensor on GPU/CPU
+        img_tensor = from_numpy(arr).to(self.device).permute(2, 0, 1).float()
+
+        # Pass 1: Strong red
+        red_mask = (img_tensor[0] > 150) & (img_tensor[0] > img_tensor[1] * 1.2) & (img_tensor[0] > img_tensor[2] * 1.5)
+        img_tensor[:, red_mask] = self.color_tensor
+
+        # Pass 2: Lighter pinkish
+        pink_mask = (img_tensor[0] > 140) & (img_tensor[0] > img_tensor[1] * 1.1) & (img_tensor[0] > img_tensor[2] * 1.2)
+        img_tensor[:, pink_mask] = self.color_tensor
+        mask = red_mask | pink_mask
+
+        # Learned palette: one table lookup per pixel, on the original colors.
+        # The 64-bit lookup index is built a band of rows at a time, not for the whole page.
+        if self.palette_lut is not None:
+            channels = from_numpy(arr).to(self.device)
+            band_masks = []
+            for top in range(0, channels.shape[0], self.PALETTE_BAND_ROWS):
+                band = channels[top:top + self.PALETTE_BAND_ROWS].long()
+                band_masks.append(self.palette_lut[(band[..., 0] << 16) | (band[..., 1] << 8) | band[..., 2]])
+            palette_mask = cat(band_masks)
+            img_tensor[:, palette_mask] = self.color_tensor
+            mask = mask | palette_mask
+
+        # These rules have no near-grey colors, so every change is ink
+        mask = mask.cpu().numpy()
+        return img_tensor.byte().permute(1, 2, 0).cpu().numpy(), mask, mask
+
+    def clean_array(self, arr):
+        """
+        Replaces the red pixels of an HxWx3 uint8 array.
+        Returns (cleaned array, boolean mask of the changed pixels).
+        """
+        return self._clean_pixels(arr)[:2]
+
+    def _clean_pixels(self, arr):
+        """
+        Like clean_array, plus a third mask of the changed pixels that are red ink.
+        """
+        if self.engine == 'cpu':
+            return self._clean_array_cpu(arr)
+        return self._clean_array_gpu(arr)
+
+    def clean_image(self, img):
+        """
+        Returns a copy of a PIL RGB image with the red pixels replaced.
+        """
+        arr, _ = self.clean_array(np.array(img.convert("RGB")))
+        return Image.fromarray(arr)
+
+    # ------------------- PAGES / DOCUMENTS ------------------- #
+    def iter_pages(self, doc):
+        """
+        Yields (page, cleaned PIL image) for every page of an open fitz.Document.
+        """
+        for page in doc:
+            bands = [arr for _, arr, _ in self._clean_page(page)]
+            yield page, Image.fromarray(np.vstack(bands))
+
+    def _encode_page(self, bands):
+        """
+        Turns the cleaned bands of a page into the record written to the output:
+        (width, height, [(pixel rect, image bytes or None for a fill, digest)]).
+        Each band is encoded as soon as it is cleaned, so only one is held at a time.
+        """
+        width = height = 0
+        patches = []
+        for top, arr, mask in bands:
+            band_height, width = mask.shape
+            height = top + band_height
+            if self.output == 'raster':
+                regions = [(0, 0, width, band_height)]
+            else:
+                regions = changed_regions(mask)
+
+            for x0, y0, x1, y1 in regions:
+                if self.output == 'fill':
+                    patches.append(((x0, top + y0, x1, top + y1), None, None))
+                    continue
+                img_byte_arr = io.BytesIO()
+                if self.output == 'raster':
+                    Image.fromarray(arr).save(img_byte_arr, format=self.image_format, quality=self.jpeg_quality)
                 else:
-                    for color, delta in target_colors:
-                        if abs(r - color[0]) <= delta and abs(g - color[1]) <= delta and abs(b - color[2]) <= delta:
-                            pixels[x, y] = (255, 255, 255)
-                            break
+                    Image.fromarray(arr[y0:y1, x0:x1]).save(img_byte_arr, format='PNG')
+                image = img_byte_arr.getvalue()
+                patches.append(((x0, top + y0, x1, top + y1), image, hashlib.sha1(image).digest()))
+        return width, height, patches
+
+    def _write_page(self, new_doc, record, xrefs, page_rect):
+        """
+        Adds one encoded page to new_doc: a new page of the source page's size
+        (page_rect, in points) holding the image in raster mode, so the physical
+        size does not depend on the render DPI; patches over the just-copied
+        original page otherwise. Pixel rectangles are
+        scaled to page points and derotated, because insert_image/draw_rect work
+        in unrotated coordinates. Images already in new_doc (same digest) are
+        referenced by xref instead of being stored again.
+        """
+        width, height, patches = record
+        if self.output == 'raster':
+            new_page = new_doc.new_page(width=page_rect.width, height=page_rect.height)
+        else:
+            new_page = new_doc[-1]
+
+        scale_x = new_page.rect.width / width
+        scale_y = new_page.rect.height / height
+        rects = [fitz.Rect(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y) * new_page.derotation_matrix
+                 for (x0, y0, x1, y1), _, _ in patches]
+        if self.output != 'raster' and rects:
+            self._remove_text(new_page, rects)
+
+        for rect, (_, image, digest) in zip(rects, patches):
+            if image is None:
+                new_page.draw_rect(rect, color=None, fill=[c / 255 for c in self.colorrgb], overlay=True)
+            elif digest in xrefs:
+                new_page.insert_image(rect, xref=xrefs[digest], rotate=new_page.rotation, keep_proportion=False)
+            else:
+                xref = new_page.insert_image(rect, stream=image, rotate=new_page.rotation, keep_proportion=False)
+                if xref:
+                    xrefs[digest] = xref
+
+    def _is_red_color(self, srgb):
+        """
+        Classifies a text color (sRGB integer) with the red ink rules of the pixels.
+        """
+        if srgb not in self.text_colors:
+            rgb = np.array([[[(srgb >> 16) & 255, (srgb >> 8) & 255, srgb & 255]]], dtype=np.uint8)
+            self.text_colors[srgb] = bool(self._clean_pixels(rgb)[2][0, 0])
+        return self.text_colors[srgb]
+
+    def _remove_text(self, page, rects):
+        """
+        Deletes red text under the cleaned regions from the text layer, so the
+        removed marks cannot be selected or extracted from behind the patches.
+        Each character is redacted through a point-sized area at its center,
+        so neighboring characters in other colors stay untouched.
+        rects are in unrotated page coordinates, like the extracted text.
+        """
+        bounds = functools.reduce(lambda a, b: a | b, rects, fitz.Rect(rects[0]))
+        redacted = False
+        for block in page.get_text('rawdict', flags=0)['blocks']:
+            for line in block.get('lines', ()):
+                for span in line['spans']:
+                    if not self._is_red_color(span['color']) or not fitz.Rect(span['bbox']).intersects(bounds):
+                        continue
+                    for char in span['chars']:
+                        bbox = fitz.Rect(char['bbox'])
+                        if any(bbox.intersects(rect) for rect in rects):
+                            center = (bbox.tl + bbox.br) / 2
+                            page.add_redact_annot(fitz.Rect(center, center) + (-0.5, -0.5, 0.5, 0.5), fill=False)
+                            redacted = True
+        if redacted:
+            page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE, graphics=fitz.PDF_REDACT_LINE_ART_NONE)
+
+    def _copy_page(self, doc, page_number, new_doc):
+        """
+        Appends a source page to new_doc for overlay and fill output.
+        Annotations and form fields are drawn above the page content, and so
+        above the patches; pages that have them are flattened first (on a
+        one-page copy) so their red marks are cleaned like everything else.
+        """
+        page = doc[page_number]
+        if page.first_annot is None and page.first_widget is None:
+            new_doc.insert_pdf(doc, from_page=page_number, to_page=page_number)
+            return
+        single = fitz.open()
+        try:
+            single.insert_pdf(doc, from_page=page_number, to_page=page_number)
+            single.bake()
+            new_doc.insert_pdf(single)
+        finally:
+            single.close()
+
+    def _clean_page(self, page):
+        """
+        Renders and cleans a page, yielding (top pixel row, cleaned array, red ink mask)
+        for the whole page, or for each band of tile_height rows when tiling.
+        """
+        dpi = choose_dpi(page, self.min_dpi, self.max_dpi) if self.dpi == 'auto' else self.dpi
+        if self.tile_height:
+            band_points = self.tile_height * 72 / dpi
+            clips = [fitz.Rect(0, y, page.rect.width, min(y + band_points, page.rect.height))
+                     for y in np.arange(0, page.rect.height, band_points)]
+        else:
+            clips = [None]
+
+        top = 0
+        for clip in clips:
+            pix = page.get_pixmap(dpi=dpi, clip=clip)
+            self.largest_band = max(self.largest_band, pix.width * pix.height)
+            arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n).copy()
+            del pix
+            arr, _, ink = self._clean_pixels(arr)
+            yield top, arr, ink
+            top += ink.shape[0]
 
-        # Second pass - convert remaining reddish pixels (adjust thresholds as needed)
-        for y in range(img.height):
-            for x in range(img.width):
-                r, g, b = pixels[x, y]
-                if r > g and r > b and r > 180:  # Adjust threshold for reddishness
-                    pixels[x, y] = (255, 255, 255)
+    def _write_document(self, doc, writer, progress_callback=None):
+        """
+        Cleans every page of doc into writer.doc, telling the writer after each page.
+        With a page cache, pages seen before (in this or an earlier document)
+        are not rendered or classified again.
+        """
+        xrefs = {}
+        total_pages = len(doc)
+        for page_number, page in enumerate(doc):
+            key = self.cache.key(page, self.settings) if self.cache is not None else None
+            record = self.cache.get(key) if key else None
+            if record is None:
+                record = self._encode_page(self._clean_page(page))
+                if key:
+                    self.cache.put(key, record)
 
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='JPEG', quality=100)
-        img_byte_arr.seek(0)
-        new_page = new_doc.new_page(width=pix.width, height=pix.height)
-        new_page.insert_image(new_page.rect, stream=img_byte_arr.read())
+            if self.output != 'raster':
+                self._copy_page(doc, page_number, writer.doc)
+            self._write_page(writer.doc, record, xrefs, page.rect)
+            writer.page_added()
 
-    new_doc.save(output_pdf)
+            # Update progress
+            if progress_callback:
+                progress_callback(((page_number + 1) / total_pages) * 100)
 
+    def process_document(self, doc, progress_callback=None):
+        """
+        Returns a new in-memory fitz.Document holding the cleaned pages of doc.
+        """
+        writer = PdfWriter(None)
+        self._write_document(doc, writer, progress_callback)
+        return writer.doc
 
-def process_directory(source_dir, target_dir):
+    def process_bytes(self, data, progress_callback=None):
+        """
+        Cleans a PDF held in memory and returns the cleaned PDF bytes.
+        """
+        doc = fitz.open(stream=data, filetype="pdf")
+        new_doc = self.process_document(doc, progress_callback)
+        try:
+            return new_doc.tobytes(**PdfWriter.SAVE_OPTIONS)
+        finally:
+            doc.close()
+            new_doc.close()
+
+    def process_file(self, input_pdf, output_pdf, progress_callback=None, **save_options):
+        """
+        Cleans input_pdf into output_pdf through a PdfWriter: pages are flushed to
+        disk as they are done and output_pdf only appears once it is complete.
+        """
+        doc = fitz.open(input_pdf)
+        writer = PdfWriter(output_pdf, **save_options)
+        try:
+            self._write_document(doc, writer, progress_callback)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            doc.close()
+
+
+# Compiled Muters shared by every call in this process, keyed by their settings
+_muters = {}
+
+
+def get_muter(engine='cpu', color='white', **options):
+    key = (engine, color) + tuple(sorted(options.items()))
+    if key not in _muters:
+        _muters[key] = Muter(engine, color, **options)
+    return _muters[key]
+
+
+# ------------- RED REMOVAL LOGIC (CPU) ------------- #
+def remove_red_pixels(input_pdf, output_pdf, progress_callback=None, color='white', dpi='auto'):
+    """
+    Remove red (or pink) pixels from a PDF by converting them to white/black.
+    Uses CPU-based approach with PyMuPDF + a precompiled color lookup table.
+    Pages are rendered at the DPI their content needs unless dpi is given.
+    """
+    get_muter('cpu', color, dpi=dpi).process_file(input_pdf, output_pdf, progress_callback)
+
+
+# ------------- RED REMOVAL LOGIC (GPU) ------------- #
+def remove_red_pixels_gpu(input_pdf, output_pdf, progress_callback=None, color='white', dpi='auto'):
+    """
+    Remove red (or pink) pixels from a PDF by converting them to white/black.
+    Uses GPU-based approach via PyTorch Tensors.
+    Pages are rendered at the DPI their content needs unless dpi is given.
+    """
+    get_muter('gpu', color, dpi=dpi).process_file(input_pdf, output_pdf, progress_callback)
+
+
+# Engine name -> red removal function, shared by the GUI, the batch runner and the job server
+ENGINES = {
+    'cpu': remove_red_pixels,
+    'gpu': remove_red_pixels_gpu,
+}
+
+
+def warm_up(engines=('cpu',), colors=('white', 'black')):
+    """
+    Pay one-time engine setup costs up front (rule compilation, torch import,
+    CUDA context), so the first real job does not.
+    """
+    for engine in engines:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        for color in colors:
+            get_muter(engine, color)
+
+
+def process_directory(source_dir, target_dir, color='white'):
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)  # Create target directory if it doesn't exist
 
+    # One cache for the whole batch: pages shared between exams are cleaned once
+    muter = Muter(color=color, dpi='auto', cache=PageCache())
     for filename in os.listdir(source_dir):
         if filename.endswith('.pdf'):
             input_path = os.path.join(source_dir, filename)
             output_path = os.path.join(target_dir, filename)
-            remove_red_pixels(input_path, output_path)
+            muter.process_file(input_path, output_path)
             print(f"Processed {filename} and saved to {target_dir}")
 
 
-# Example usage
-source_directory = "exams"
-target_directory = "no solution"
-process_directory(source_directory, target_directory)
+# ------------- HEADLESS BATCH CLI ------------- #
+def clean_file(input_pdf, output_pdf, engine='cpu', color='white', cache=None, on_page=None, **options):
+    """
+    Cleans one PDF and returns its stats: pages, wall seconds, bytes in and out.
+    on_page(page_number, percent) is called after every page.
+    """
+    started = time.perf_counter()
+    pages = []
+
+    def on_progress(percent):
+        pages.append(percent)
+        if on_page:
+            on_page(len(pages), percent)
+
+    get_muter(engine, color, cache=cache, **options).process_file(input_pdf, output_pdf, on_progress)
+    return {
+        'pages': len(pages),
+        'seconds': time.perf_counter() - started,
+        'bytes_in': os.path.getsize(input_pdf),
+        'bytes_out': os.path.getsize(output_pdf),
+    }
+
+
+# Per worker process state for batch runs
+_batch_cache = None
+_batch_events = None
+
+
+def _init_batch_worker(engine, events):
+    global _batch_cache, _batch_events
+    warm_up((engine,))
+    _batch_cache = PageCache()
+    _batch_events = events
+
+
+def _clean_file_in_worker(input_pdf, output_pdf, engine, color, options):
+    def on_page(page_number, percent):
+        _batch_events.put({'event': 'page', 'input': input_pdf, 'page': page_number, 'percent': round(percent, 1)})
+
+    return clean_file(input_pdf, output_pdf, engine, color, cache=_batch_cache, on_page=on_page, **options)
+
+
+def _collect_inputs(inputs, output_dir):
+    """
+    Expands files and directories (their *.pdf files, not recursive) into
+    (input, output) pairs inside output_dir. A file listed twice is cleaned
+    once; different files with the same name would overwrite each other's
+    output, so they raise ValueError.
+    """
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.lower().endswith('.pdf'))
+            files.extend(os.path.join(path, name) for name in names)
+        else:
+            files.append(path)
+
+    pairs = []
+    sources = {}  # output path -> real path of its input
+    for path in files:
+        output_path = os.path.join(output_dir, os.path.basename(path))
+        source = sources.setdefault(output_path, os.path.realpath(path))
+        if source != os.path.realpath(path):
+            raise ValueError(f"{path} and {source} would both be written to {output_path}")
+        if output_path not in (pair[1] for pair in pairs):
+            pairs.append((path, output_path))
+    return pairs
+
+
+class BatchReport:
+    """
+    Collects per-file results and prints progress, either as JSON lines
+    (one event object per line) or as plain text.
+    """
+
+    def __init__(self, as_json=False):
+        self.as_json = as_json
+        self.started = time.perf_counter()
+        self.files = []
+        self.failures = []
+        # Page events come from a forwarding thread; one write per line keeps lines whole
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        if self.as_json:
+            event = dict(event, time=round(time.perf_counter() - self.started, 3))
+            with self.lock:
+                sys.stdout.write(json.dumps(event) + '\n')
+                sys.stdout.flush()
+
+    def file_done(self, input_pdf, output_pdf, stats, error=None, **extra):
+        if error is not None:
+            self.failures.append({'input': input_pdf, 'error': str(error)})
+            self.emit({'event': 'file_failed', 'input': input_pdf, 'error': str(error)})
+            if not self.as_json:
+                print(f"Failed to process {input_pdf}: {error}")
+            return
+
+        result = dict(stats, input=input_pdf, output=output_pdf, **extra)
+        result['seconds'] = round(result['seconds'], 3)
+        self.files.append(result)
+        self.emit(dict(result, event='file_done'))
+        if not self.as_json:
+            print(f"Processed {os.path.basename(input_pdf)} and saved to {os.path.dirname(output_pdf)} "
+                  f"({result['pages']} pages, {result['seconds']:.1f}s)")
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        pages = sum(result['pages'] for result in self.files)
+        bytes_in = sum(result['bytes_in'] for result in self.files)
+        bytes_out = sum(result['bytes_out'] for result in self.files)
+        return {
+            'files': len(self.files) + len(self.failures),
+            'succeeded': len(self.files),
+            'failed': len(self.failures),
+            'pages': pages,
+            'wall_seconds': round(wall, 3),
+            'pages_per_second': round(pages / wall, 3) if wall else 0.0,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'per_file': self.files,
+            'failures': self.failures,
+        }
+
+    def finish(self):
+        summary = self.summary()
+        self.emit(dict(summary, event='summary'))
+        if not self.as_json:
+            print(f"{summary['succeeded']}/{summary['files']} files, {summary['pages']} pages in "
+                  f"{summary['wall_seconds']:.1f}s ({summary['pages_per_second']:.2f} pages/s), "
+                  f"{summary['bytes_in']} bytes in, {summary['bytes_out']} bytes out")
+        return summary
+
+
+def _dpi_argument(value):
+    return value if value == 'auto' else int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove red marks from PDFs in batch")
+    parser.add_argument('inputs', nargs='*', default=['exams'], help="PDF files or folders of PDFs")
+    parser.add_argument('-o', '--output-dir', default='no solution')
+    parser.add_argument('--engine', default='cpu', choices=sorted(ENGINES))
+    parser.add_argument('--workers', type=int, default=1, help="Files processed in parallel")
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help="Let the resource governor pick DPI, tiling and workers (up to --workers) within this budget")
+    parser.add_argument('--dpi', type=_dpi_argument, default='auto', help="Render DPI, or 'auto' per page")
+    parser.add_argument('--min-dpi', type=int, default=100)
+    parser.add_argument('--max-dpi', type=int, default=300)
+    parser.add_argument('--color', default='white', choices=['white', 'black'])
+    parser.add_argument('--output-mode', default='raster', choices=['raster', 'overlay', 'fill'])
+    parser.add_argument('--image-format', default='JPEG', type=str.upper, choices=['JPEG', 'PNG'],
+                        help="Encoding of raster pages")
+    parser.add_argument('--jpeg-quality', type=int, default=100)
+    parser.add_argument('--palette', help="Learned palette from palette.py")
+    parser.add_argument('--json', action='store_true', help="Print JSON-lines progress events")
+    parser.add_argument('--report', help="Also write the summary report to this JSON file")
+    args = parser.parse_args(argv)
+    if args.memory_budget and args.dpi != 'auto':
+        parser.error("--dpi cannot be combined with --memory-budget, which picks the DPI (use --max-dpi)")
+
+    try:
+        files = _collect_inputs(args.inputs, args.output_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)  # Create target directory if it doesn't exist
+
+    options = {
+        'output': args.output_mode,
+        'image_format': args.image_format,
+        'jpeg_quality': args.jpeg_quality,
+        'palette': args.palette,
+    }
+    report = BatchReport(as_json=args.json)
+    report.emit({'event': 'start', 'files': len(files), 'engine': args.engine, 'workers': args.workers,
+                 'memory_budget_mb': args.memory_budget, 'dpi': args.dpi, 'color': args.color, **options})
+
+    if args.memory_budget:
+        from governor import run_batch
+
+        def on_done(input_pdf, output_pdf, plan, error, outcome):
+            stats = None
+            if error is None:
+                stats = {'pages': outcome['pages'], 'seconds': outcome['seconds'],
+                         'bytes_in': os.path.getsize(input_pdf), 'bytes_out': os.path.getsize(output_pdf)}
+            report.file_done(input_pdf, output_pdf, stats, error, plan=plan)
+
+        def on_page(input_pdf, page_number, percent):
+            report.emit({'event': 'page', 'input': input_pdf, 'page': page_number, 'percent': round(percent, 1)})
+
+        run_batch(files, args.memory_budget * 1024 * 1024, cpu_budget=args.workers, engine=args.engine,
+                  color=args.color, max_dpi=args.max_dpi, min_dpi=args.min_dpi, on_done=on_done, on_page=on_page,
+                  **options)
+
+    elif args.workers <= 1:
+        cache = PageCache()
+        for input_pdf, output_pdf in files:
+            def on_page(page_number, percent):
+                report.emit({'event': 'page', 'input': input_pdf, 'page': page_number, 'percent': round(percent, 1)})
+            try:
+                stats = clean_file(input_pdf, output_pdf, args.engine, args.color, cache=cache, on_page=on_page,
+                                   dpi=args.dpi, min_dpi=args.min_dpi, max_dpi=args.max_dpi, **options)
+                report.file_done(input_pdf, output_pdf, stats)
+            except Exception as e:
+                report.file_done(input_pdf, output_pdf, None, e)
+
+    else:
+        options.update(dpi=args.dpi, min_dpi=args.min_dpi, max_dpi=args.max_dpi)
+        events = multiprocessing.get_context('spawn').Queue()
+
+        def forward_events():
+            for event in iter(events.get, None):
+                report.emit(event)
+
+        forwarder = threading.Thread(target=forward_events, daemon=True)
+        forwarder.start()
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker,
+                                 initargs=(args.engine, events),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(_clean_file_in_worker, input_pdf, output_pdf, args.engine, args.color, options):
+                       (input_pdf, output_pdf) for input_pdf, output_pdf in files}
+            for future in as_completed(futures):
+                input_pdf, output_pdf = futures[future]
+                error = future.exception()
+                report.file_done(input_pdf, output_pdf, None if error else future.result(), error)
+        events.put(None)
+        forwarder.join()
+
+    summary = report.finish()
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary['failed'] else 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,7 +25,6 @@ Changes from v1 to v2:
    - Code refactoring and improved naming.
 """
 
-import io
 import os
 import sys
 import time
@@ -34,16 +33,11 @@ import webbrowser
 import uuid
 from pathlib import Path
 
-import fitz  # PyMuPDF
-import numpy as np
+import pymupdf as fitz  # PyMuPDF
 from PIL import Image, ImageTk
 from tkinter import Tk, Frame, Canvas, Label, Button, Toplevel, filedialog, StringVar
 from tkinter import ttk
 
-# Torch is only used in the remove_red_pixels_gpu function
-from torch import tensor, device
-from torch.cuda import is_available as cuda_is_available
-
 import tempfile
 import pythoncom
 import win32com.client
@@ -54,125 +48,9 @@ os.chdir(sys._MEIPASS)
 
 
 
-# ------------- RED REMOVAL LOGIC (CPU) ------------- #
-def remove_red_pixels(input_pdf, output_pdf, progress_callback, color):
-    """
-    Remove red (or pink) pixels from a PDF by converting them to white/black.
-    Uses CPU-based approach with PyMuPDF + PIL.
-    """
-    doc = fitz.open(input_pdf)
-    new_doc = fitz.Document()
-    colorrgb = (255, 255, 255) if color == 'white' else (0, 0, 0)
-
-    # Pre-defined target colors (e.g. pink-ish or near red) with delta tolerance
-    target_colors = [
-        ((224, 202, 202), 5),
-        ((218, 203, 204), 5),
-        ((229, 220, 220), 5),
-        ((230, 212, 220), 5),
-        ((215, 190, 197), 5),
-        ((254, 251, 249), 5),
-        ((197, 193, 194), 5),
-        ((197, 195, 196), 5),
-        ((198, 194, 195), 5),
-        ((200, 192, 195), 5),
-        ((200, 195, 195), 5),
-        ((200, 196, 195), 5),
-        ((201, 193, 194), 5),
-        ((202, 185, 187), 5),
-        ((203, 199, 198), 5),
-        ((205, 203, 204), 5),
-    ]
-
-    total_pages = len(doc)
-    for page_number, page in enumerate(doc):
-        pix = page.get_pixmap(dpi=300)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        pixels = img.load()
-
-        # Pass 1: Intense red + target colors
-        for y in range(img.height):
-            for x in range(img.width):
-                r, g, b = pixels[x, y]
-
-                # Condition for intense red
-                if r > 150 and r > g * 1.2 and r > b * 1.5 and (r + g + b) > 100:
-                    pixels[x, y] = colorrgb
-                else:
-                    for ccheck, delta in target_colors:
-                        if abs(r - ccheck[0]) <= delta and \
-                           abs(g - ccheck[1]) <= delta and \
-                           abs(b - ccheck[2]) <= delta:
-                            pixels[x, y] = colorrgb
-                            break
-
-        # Pass 2: Additional pass for leftover reds if color is white
-        if color == 'white':
-            for y in range(img.height):
-                for x in range(img.width):
-                    r, g, b = pixels[x, y]
-                    if r > g and r > b and r > 180:
-                        pixels[x, y] = (255, 255, 255)
-
-        # Save to PDF
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='JPEG', quality=100)
-        img_byte_arr.seek(0)
-        new_page = new_doc.new_page(width=pix.width, height=pix.height)
-        new_page.insert_image(new_page.rect, stream=img_byte_arr.read())
-
-        # Update progress
-        progress_callback(((page_number + 1) / total_pages) * 100)
-
-    # Save the processed PDF
-    new_doc.save(output_pdf)
-    doc.close()
-    new_doc.close()
-
-
-# ------------- RED REMOVAL LOGIC (GPU) ------------- #
-def remove_red_pixels_gpu(input_pdf, output_pdf, progress_callback, color):
-    """
-    Remove red (or pink) pixels from a PDF by converting them to white/black.
-    Uses GPU-based approach via PyTorch Tensors.
-    """
-    doc = fitz.open(input_pdf)
-    new_doc = fitz.Document()
-    device_gpu = device("cuda" if cuda_is_available() else "cpu")
-    colorrgb = (255.0, 255.0, 255.0) if color == 'white' else (0.0, 0.0, 0.0)
-
-    total_pages = len(doc)
-    for page_number, page in enumerate(doc):
-        pix = page.get_pixmap(dpi=300)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-        # Convert to tensor on GPU/CPU
-        img_tensor = tensor(np.array(img), device=device_gpu).permute(2, 0, 1).float()
-
-        # Pass 1: Strong red
-        red_mask = (img_tensor[0] > 150) & (img_tensor[0] > img_tensor[1] * 1.2) & (img_tensor[0] > img_tensor[2] * 1.5)
-        img_tensor[:, red_mask] = tensor(colorrgb, device=device_gpu).view(3, 1)
-
-        # Pass 2: Lighter pinkish
-        pink_mask = (img_tensor[0] > 140) & (img_tensor[0] > img_tensor[1] * 1.1) & (img_tensor[0] > img_tensor[2] * 1.2)
-        img_tensor[:, pink_mask] = tensor(colorrgb, device=device_gpu).view(3, 1)
-
-        # Convert back to PIL
-        final_img = Image.fromarray(img_tensor.byte().permute(1, 2, 0).cpu().numpy())
-        img_byte_arr = io.BytesIO()
-        final_img.save(img_byte_arr, format='JPEG', quality=100)
-        img_byte_arr.seek(0)
-
-        # Insert into new PDF
-        new_page = new_doc.new_page(width=pix.width, height=pix.height)
-        new_page.insert_image(new_page.rect, stream=img_byte_arr.read())
-
-        # Update progress
-        progress_callback(((page_number + 1) / total_pages) * 100)
-
-    new_doc.save(output_pdf)
-    doc.close()
-    new_doc.close()
+# ------------- RED REMOVAL LOGIC (CPU / GPU) ------------- #
+# Shared with the batch runner and the job server
+from main import remove_red_pixels, remove_red_pixels_gpu
 
 
 # ------------- DOCX / DOC -> PDF CONVERSION ------------- #
@@ -0,0 +1,153 @@
+"""
+PDFMute palette learning.
+
+Calibrates the red-removal rules for a new scanner or pen from examples
+instead of hand-picking target colors. Give it a few pages with red marks and
+a few unmarked reference pages of the same kind; it histograms their colors
+on a quantized RGB grid and keeps the color cells that are much more common
+on the marked pages than on the reference pages. The result is saved as a
+lookup table that the engines evaluate in constant time per pixel, on top of
+the built-in rules.
+
+The ink colors are also clustered (k-means) so the learned palette can be
+reviewed at a glance.
+
+Usage:
+  python palette.py --marked marked1.pdf marked2.pdf --reference clean.pdf -o pen_batch.npz
+
+  from main import Muter
+  from palette import Palette
+  muter = Muter(palette=Palette.load("pen_batch.npz"))
+"""
+
+import argparse
+import hashlib
+
+import pymupdf as fitz  # PyMuPDF
+import numpy as np
+
+
+def sample_colors(pdf_paths, dpi=100):
+    """
+    Returns all rendered pixels of the given PDFs as an Nx3 uint8 array.
+    Colors don't need resolution, so a low DPI keeps this quick.
+    """
+    samples = []
+    for pdf_path in pdf_paths:
+        doc = fitz.open(pdf_path)
+        for page in doc:
+            pix = page.get_pixmap(dpi=dpi)
+            samples.append(np.frombuffer(pix.samples, dtype=np.uint8).reshape(-1, pix.n)[:, :3].copy())
+        doc.close()
+    return np.concatenate(samples) if samples else np.zeros((0, 3), dtype=np.uint8)
+
+
+def _cell_index(colors, bits):
+    shift = 8 - bits
+    colors = colors.astype(np.uint32) >> shift
+    return (colors[..., 0] << (2 * bits)) | (colors[..., 1] << bits) | colors[..., 2]
+
+
+def _kmeans(points, weights, k, iterations=20):
+    """
+    Weighted k-means over color cells. Returns (centers, weight share per center).
+    """
+    k = min(k, len(points))
+    # Start from the heaviest cells, which are the most typical ink colors
+    centers = points[np.argsort(weights)[::-1][:k]].astype(np.float64)
+    for _ in range(iterations):
+        distances = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        nearest = distances.argmin(axis=1)
+        for i in range(k):
+            members = nearest == i
+            if members.any():
+                centers[i] = np.average(points[members], axis=0, weights=weights[members])
+    shares = np.bincount(nearest, weights=weights, minlength=k) / weights.sum()
+    return centers, shares
+
+
+class Palette:
+    """
+    A learned set of ink color cells on a 2**bits per channel RGB grid.
+    """
+
+    def __init__(self, cells, bits=5, centers=None, shares=None):
+        self.cells = np.asarray(cells, dtype=bool)
+        self.bits = bits
+        self.centers = np.zeros((0, 3)) if centers is None else np.asarray(centers)
+        self.shares = np.zeros(0) if shares is None else np.asarray(shares)
+        self.digest = hashlib.sha1(np.packbits(self.cells).tobytes() + bytes([bits])).hexdigest()
+        self._lut = None
+
+    @property
+    def lut(self):
+        """
+        Boolean lookup table over all 24-bit colors, indexed by (r << 16) | (g << 8) | b,
+        in the same layout as main.compile_rules.
+        """
+        if self._lut is None:
+            levels = np.arange(256, dtype=np.uint32) >> (8 - self.bits)
+            green_blue = ((levels[:, None] << self.bits) | levels[None, :]).ravel()
+            self._lut = np.empty(1 << 24, dtype=bool)
+            for r in range(256):
+                self._lut[r << 16:(r + 1) << 16] = self.cells[(levels[r] << (2 * self.bits)) | green_blue]
+        return self._lut
+
+    def save(self, path):
+        np.savez_compressed(path, cells=self.cells, bits=self.bits, centers=self.centers, shares=self.shares)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['cells'], int(data['bits']), data['centers'], data['shares'])
+
+
+def learn_palette(marked_pdfs, reference_pdfs, bits=5, ratio=20.0, min_count=50, clusters=8, dpi=100):
+    """
+    Learns the ink colors that appear on marked pages but not on reference pages.
+    A color cell counts as ink when it occurs at least min_count times on the
+    marked pages and is at least `ratio` times more frequent there than on the
+    reference pages (with add-one smoothing, so unseen cells are not free).
+    """
+    cell_count = 1 << (3 * bits)
+    marked = np.bincount(_cell_index(sample_colors(marked_pdfs, dpi), bits), minlength=cell_count)
+    reference = np.bincount(_cell_index(sample_colors(reference_pdfs, dpi), bits), minlength=cell_count)
+    if not marked.sum():
+        raise ValueError("The marked PDFs have no pages")
+
+    marked_share = marked / marked.sum()
+    reference_share = (reference + 1) / (reference.sum() + cell_count)
+    cells = (marked >= min_count) & (marked_share >= ratio * reference_share)
+
+    centers, shares = None, None
+    if cells.any():
+        indices = np.flatnonzero(cells)
+        mask = (1 << bits) - 1
+        half_step = 1 << (7 - bits)
+        points = np.stack([indices >> (2 * bits), (indices >> bits) & mask, indices & mask], axis=-1)
+        points = (points << (8 - bits)) + half_step  # Cell centers in 0..255
+        centers, shares = _kmeans(points.astype(np.float64), marked[indices].astype(np.float64), clusters)
+    return Palette(cells, bits, centers, shares)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Learn red-ink colors from sample pages")
+    parser.add_argument('--marked', nargs='+', required=True, help="PDFs with red marks")
+    parser.add_argument('--reference', nargs='+', required=True, help="Unmarked PDFs of the same kind")
+    parser.add_argument('-o', '--output', required=True, help="Palette file to write (.npz)")
+    parser.add_argument('--bits', type=int, default=5, help="Bits per channel of the color grid")
+    parser.add_argument('--ratio', type=float, default=20.0)
+    parser.add_argument('--min-count', type=int, default=50)
+    parser.add_argument('--clusters', type=int, default=8)
+    args = parser.parse_args()
+
+    palette = learn_palette(args.marked, args.reference, bits=args.bits, ratio=args.ratio,
+                            min_count=args.min_count, clusters=args.clusters)
+    palette.save(args.output)
+    print(f"Learned {int(palette.cells.sum())} ink color cells, saved to {args.output}")
+    for center, share in sorted(zip(palette.centers, palette.shares), key=lambda item: -item[1]):
+        print(f"  RGB{tuple(int(round(c)) for c in center)}  {share:.1%} of ink pixels")
+
+
+if __name__ == "__main__":
+    main()
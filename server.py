@@ -0,0 +1,464 @@
+"""
+PDFMute job server.
+
+Keeps the red-removal engines warm in a pool of worker processes and accepts
+jobs over local HTTP, either on a loopback TCP port or on a Unix socket.
+
+Endpoints:
+  POST /jobs              Submit a job. Either a JSON body
+                          {"input": "in.pdf", "output": "out.pdf", "engine": "cpu", "color": "white"}
+                          or the raw PDF bytes (Content-Type: application/pdf) with
+                          ?engine=cpu&color=white in the query string.
+  GET  /jobs/<id>         Job status.
+  GET  /jobs/<id>/result  Cleaned PDF bytes (jobs submitted as bytes), handed out once.
+  GET  /metrics           Queue depth and throughput counters.
+
+When all workers are busy and the queue is full, new jobs are rejected with
+503 and a Retry-After header instead of piling up in memory. Uploads larger
+than --max-upload-mb get 413. Cleaned PDFs of byte jobs are kept until they
+are fetched once, or for --result-ttl seconds, whichever comes first.
+
+If a worker process dies (e.g. killed for running out of memory), the jobs it
+had are marked failed and the pool is restarted for the next ones.
+
+Usage:
+  python server.py --port 8765 --workers 2
+  python server.py --unix-socket /tmp/pdfmute.sock --engines cpu gpu
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from main import ENGINES, PageCache, get_muter, warm_up
+
+
+# ------------- WORKER PROCESS ------------- #
+# Cleaned pages cached by this worker process, shared by all jobs it runs
+_page_cache = None
+
+
+def _init_worker(engines):
+    """
+    Runs once in every worker process, so engine setup is paid at startup only.
+    """
+    global _page_cache
+    warm_up(engines)
+    _page_cache = PageCache()
+
+
+def _run_job(engine, color, input_pdf, output_pdf, data):
+    """
+    Runs one job inside a worker process.
+    Returns the page count, byte counts and (for byte jobs) the cleaned PDF.
+    """
+    started = time.perf_counter()
+    pages = []
+
+    def count_pages(value):
+        pages.append(value)
+
+    muter = get_muter(engine, color, dpi='auto', cache=_page_cache)
+    result = None
+    if data is not None:
+        result = muter.process_bytes(data, count_pages)
+        bytes_in, bytes_out = len(data), len(result)
+    else:
+        muter.process_file(input_pdf, output_pdf, count_pages)
+        bytes_in, bytes_out = os.path.getsize(input_pdf), os.path.getsize(output_pdf)
+
+    return {'pages': len(pages), 'bytes_in': bytes_in, 'bytes_out': bytes_out, 'result': result,
+            'seconds': time.perf_counter() - started}
+
+
+# ------------- JOB QUEUE ------------- #
+class Job:
+    def __init__(self, engine, color, input_pdf=None, output_pdf=None):
+        self.id = uuid.uuid4().hex
+        self.engine = engine
+        self.color = color
+        self.input_pdf = input_pdf
+        self.output_pdf = output_pdf
+        self.future = None
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.run_seconds = None
+        self.executor = None
+
+    def current_state(self):
+        if self.state == 'queued' and self.future is not None and self.future.running():
+            return 'running'
+        return self.state
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'state': self.current_state(),
+            'engine': self.engine,
+            'color': self.color,
+            'input': self.input_pdf,
+            'output': self.output_pdf,
+            'error': self.error,
+            'pages': self.pages,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'total_seconds': (self.finished_at or time.time()) - self.submitted_at,
+            'run_seconds': self.run_seconds,
+            'has_result': self.result is not None,
+        }
+
+
+class JobQueue:
+    """
+    Bounded job queue in front of a warm process pool.
+    At most workers + max_queued jobs are accepted at a time; submit()
+    returns None beyond that so the caller can push back.
+    """
+
+    def __init__(self, workers=2, max_queued=8, engines=('cpu',), keep_finished=1000, result_ttl=600):
+        self.engines = tuple(engines)
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + max_queued)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.keep_finished = keep_finished
+        self.result_ttl = result_ttl
+        self.started_at = time.time()
+        self.counters = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'pool_restarts': 0,
+            'pages': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'busy_seconds': 0.0,
+        }
+        self.executor = self._start_pool()
+
+        # Wait for every worker now so engine warm-up is not paid by the first jobs
+        for future in self._prestart(self.executor):
+            future.result()
+
+    def _start_pool(self):
+        # Spawned, not forked: pools are also restarted from request and callback threads
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(self.engines,), mp_context=multiprocessing.get_context('spawn'))
+
+    def _prestart(self, executor):
+        return [executor.submit(os.getpid) for _ in range(self.workers)]
+
+    def _restart_pool(self, broken):
+        """
+        Replaces a broken executor (a worker died) unless that already happened.
+        Jobs still in the broken pool fail on their own with BrokenProcessPool.
+        """
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = self._start_pool()
+            self.counters['pool_restarts'] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._prestart(self.executor)
+
+    def submit(self, engine, color, input_pdf=None, output_pdf=None, data=None):
+        if engine not in self.engines:
+            raise ValueError(f"Engine not enabled on this server: {engine}")
+        if color not in ('white', 'black'):
+            raise ValueError(f"Unknown color: {color}")
+        if data is None and not (input_pdf and output_pdf):
+            raise ValueError("A job needs either PDF bytes or input and output paths")
+        if data is None and not (isinstance(input_pdf, str) and isinstance(output_pdf, str)):
+            raise ValueError("input and output must be paths (strings)")
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counters['rejected'] += 1
+            return None
+
+        job = Job(engine, color, input_pdf, output_pdf)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.counters['submitted'] += 1
+            self._evict_finished()
+
+        # A pool found broken here never got the job, so it is retried once on a fresh pool
+        error = None
+        for _ in range(2):
+            executor = self.executor
+            try:
+                job.future = executor.submit(_run_job, engine, color, input_pdf, output_pdf, data)
+                break
+            except BrokenProcessPool as e:
+                error = e
+                self._restart_pool(executor)
+            except Exception as e:
+                error = e
+                break
+
+        if job.future is None:
+            with self.lock:
+                job.state = 'failed'
+                job.error = f"Could not start job: {error}"
+                job.finished_at = time.time()
+                self.counters['failed'] += 1
+            self.slots.release()
+            return job
+
+        job.executor = executor
+        job.future.add_done_callback(lambda f: self._on_done(job, f))
+        return job
+
+    def _on_done(self, job, future):
+        error = None
+        with self.lock:
+            job.finished_at = time.time()
+            try:
+                outcome = future.result()
+            except BaseException as e:
+                error = e
+                job.state = 'failed'
+                job.error = str(e) or type(e).__name__
+                self.counters['failed'] += 1
+            else:
+                job.state = 'done'
+                job.pages = outcome['pages']
+                job.bytes_in = outcome['bytes_in']
+                job.bytes_out = outcome['bytes_out']
+                job.result = outcome['result']
+                job.run_seconds = outcome['seconds']
+                self.counters['completed'] += 1
+                self.counters['pages'] += job.pages
+                self.counters['bytes_in'] += job.bytes_in
+                self.counters['bytes_out'] += job.bytes_out
+                self.counters['busy_seconds'] += job.run_seconds
+        self.slots.release()
+        if isinstance(error, BrokenProcessPool):
+            self._restart_pool(job.executor)
+
+    def _evict_finished(self):
+        """
+        Drops results older than result_ttl, and the oldest finished jobs
+        (and their results) beyond keep_finished.
+        Called with the lock held.
+        """
+        now = time.time()
+        finished = [job_id for job_id, job in self.jobs.items() if job.state in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+        for job in self.jobs.values():
+            if job.result is not None and now - job.finished_at > self.result_ttl:
+                job.result = None
+
+    def get(self, job_id):
+        with self.lock:
+            self._evict_finished()
+            return self.jobs.get(job_id)
+
+    def take_result(self, job_id):
+        """
+        Returns the cleaned PDF bytes of a job and forgets them, or None.
+        """
+        with self.lock:
+            self._evict_finished()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            result, job.result = job.result, None
+            return result
+
+    def metrics(self):
+        with self.lock:
+            uptime = time.time() - self.started_at
+            states = [job.current_state() for job in self.jobs.values()]
+            counters = dict(self.counters)
+        finished = counters['completed'] + counters['failed']
+        return dict(
+            counters,
+            uptime_seconds=uptime,
+            queued=states.count('queued'),
+            running=states.count('running'),
+            pages_per_second=counters['pages'] / uptime if uptime else 0.0,
+            jobs_per_second=finished / uptime if uptime else 0.0,
+            mean_job_seconds=counters['busy_seconds'] / counters['completed'] if counters['completed'] else None,
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+# ------------- HTTP FRONT END ------------- #
+DEFAULT_MAX_BODY_BYTES = 256 * 1024 * 1024
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    server_version = "PDFMute"
+
+    def address_string(self):
+        # Unix socket peers have no host address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError("Invalid Content-Length")
+            if length > self.server.max_body_bytes:
+                # The body is not read, so the connection cannot be reused
+                self.close_connection = True
+                self._send_json(413, {'error': f"Body larger than {self.server.max_body_bytes} bytes"})
+                return
+            body = self.rfile.read(length)
+
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                fields = json.loads(body or b'{}')
+                if not isinstance(fields, dict):
+                    raise ValueError("The JSON body must be an object")
+                params.update(fields)
+                data = None
+            else:
+                data = body
+            job = self.server.jobs.submit(
+                params.get('engine', 'cpu'),
+                params.get('color', 'white'),
+                input_pdf=params.get('input'),
+                output_pdf=params.get('output'),
+                data=data,
+            )
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        if job is None:
+            self._send_json(503, {'error': 'Queue is full'}, headers={'Retry-After': '1'})
+            return
+        if job.state == 'failed':
+            self._send_json(500, job.to_dict())
+            return
+        self._send_json(202, job.to_dict(), headers={'Location': f'/jobs/{job.id}'})
+
+    def do_GET(self):
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+
+        if parts == ['metrics']:
+            self._send_json(200, self.server.jobs.metrics())
+            return
+
+        if len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.server.jobs.get(parts[1])
+            if job is None:
+                self._send_json(404, {'error': 'Unknown job'})
+            elif len(parts) == 2:
+                self._send_json(200, job.to_dict())
+            elif parts[2] == 'result':
+                # Results are handed out once, so finished jobs don't hold on to them
+                result = self.server.jobs.take_result(job.id)
+                if result is None:
+                    self._send_json(409, {'error': 'No result available'})
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/pdf')
+                self.send_header('Content-Length', str(len(result)))
+                self.end_headers()
+                self.wfile.write(result)
+            else:
+                self._send_json(404, {'error': 'Not found'})
+            return
+
+        self._send_json(404, {'error': 'Not found'})
+
+
+class JobHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs, max_body_bytes=DEFAULT_MAX_BODY_BYTES):
+        super().__init__(address, JobRequestHandler)
+        self.jobs = jobs
+        self.max_body_bytes = max_body_bytes
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixJobHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path, jobs, max_body_bytes=DEFAULT_MAX_BODY_BYTES):
+            if os.path.exists(path):
+                os.remove(path)  # Stale socket from a previous run
+            super().__init__(path, JobRequestHandler)
+            self.jobs = jobs
+            self.max_body_bytes = max_body_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PDFMute job server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', help="Listen on this Unix socket instead of TCP")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Jobs processed concurrently")
+    parser.add_argument('--max-queued', type=int, default=8,
+                        help="Jobs waiting beyond the running ones before new jobs get 503")
+    parser.add_argument('--engines', nargs='+', default=['cpu'], choices=sorted(ENGINES),
+                        help="Engines to keep warm")
+    parser.add_argument('--max-upload-mb', type=int, default=DEFAULT_MAX_BODY_BYTES // (1024 * 1024),
+                        help="Largest request body accepted")
+    parser.add_argument('--result-ttl', type=float, default=600,
+                        help="Seconds an unfetched result is kept")
+    args = parser.parse_args()
+
+    jobs = JobQueue(workers=args.workers, max_queued=args.max_queued, engines=args.engines,
+                    result_ttl=args.result_ttl)
+    max_body_bytes = args.max_upload_mb * 1024 * 1024
+    if args.unix_socket:
+        httpd = UnixJobHTTPServer(args.unix_socket, jobs, max_body_bytes)
+        print(f"PDFMute server listening on {args.unix_socket}")
+    else:
+        httpd = JobHTTPServer((args.host, args.port), jobs, max_body_bytes)
+        print(f"PDFMute server listening on http://{args.host}:{args.port}")
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        jobs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
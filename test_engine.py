@@ -0,0 +1,178 @@
+"""
+Regression tests for the pure parts of the engine: the compiled color rules,
+region grouping, render DPI choice, the page cache and the resource plan.
+
+Run with: python -m pytest -q
+"""
+
+import pymupdf as fitz  # PyMuPDF
+import numpy as np
+import pytest
+
+from main import TARGET_COLORS, PageCache, changed_regions, choose_dpi, compile_rules, page_fingerprint
+from governor import ResourceGovernor
+
+
+def reference_is_red(r, g, b, color):
+    """
+    The original per-pixel rules, pass by pass, for one color.
+    """
+    if r > 150 and r > g * 1.2 and r > b * 1.5 and (r + g + b) > 100:
+        return True
+    for ccheck, delta in TARGET_COLORS:
+        if abs(r - ccheck[0]) <= delta and abs(g - ccheck[1]) <= delta and abs(b - ccheck[2]) <= delta:
+            return True
+    return color == 'white' and r > g and r > b and r > 180
+
+
+@pytest.mark.parametrize('color', ['white', 'black'])
+def test_lut_matches_per_pixel_rules(color):
+    lut = compile_rules(color)
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, size=(100_000, 3))
+    # Also the target colors and their tolerance edges, which random colors rarely hit
+    for (r, g, b), delta in TARGET_COLORS:
+        for offset in (-delta - 1, -delta, 0, delta, delta + 1):
+            colors = np.vstack([colors, np.clip([[r + offset, g + offset, b + offset]], 0, 255)])
+
+    for r, g, b in colors.tolist():
+        assert lut[(r << 16) | (g << 8) | b] == reference_is_red(r, g, b, color), (r, g, b)
+
+
+@pytest.mark.parametrize('color', ['white', 'black'])
+def test_ink_rules_skip_grey_targets_only(color):
+    full, ink = compile_rules(color), compile_rules(color, ink_only=True)
+    index = lambda r, g, b: (r << 16) | (g << 8) | b
+    # Anti-aliased black text: a near-grey target color, not ink
+    assert full[index(200, 200, 200)] and not ink[index(200, 200, 200)]
+    # Pink ink and intense red stay ink
+    assert full[index(224, 202, 202)] and ink[index(224, 202, 202)]
+    assert ink[index(220, 30, 30)]
+    assert not (ink & ~full).any()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_changed_regions_cover_every_changed_pixel(seed):
+    rng = np.random.default_rng(seed)
+    height, width = rng.integers(1, 300, size=2)
+    mask = rng.random((height, width)) < 0.01
+
+    covered = np.zeros_like(mask)
+    for x0, y0, x1, y1 in changed_regions(mask, block=16):
+        assert 0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height
+        assert mask[y0:y1, x0:x1].any()
+        covered[y0:y1, x0:x1] = True
+    assert not (mask & ~covered).any()
+
+
+def test_changed_regions_empty_mask():
+    assert changed_regions(np.zeros((100, 80), dtype=bool)) == []
+
+
+def test_choose_dpi():
+    doc = fitz.open()
+    blank = doc.new_page()
+    assert choose_dpi(blank, min_dpi=100, max_dpi=300) == 100
+
+    text = doc.new_page()
+    text.insert_text((72, 72), "Question 1")
+    assert choose_dpi(text, min_dpi=100, max_dpi=300, vector_dpi=200) == 200
+
+    # A full-page scan at 150 DPI sets the DPI, despite its OCR-like text layer
+    scan = doc.new_page(width=612, height=792)
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 1275, 1650), False)
+    pix.clear_with(200)
+    scan.insert_image(scan.rect, pixmap=pix)
+    scan.insert_text((72, 72), "Question 1")
+    assert choose_dpi(scan, min_dpi=100, max_dpi=300) == 150
+    assert choose_dpi(scan, min_dpi=100, max_dpi=120) == 120
+
+
+def _graphics_state_page(alpha, padding_pages=0):
+    doc = fitz.open()
+    for _ in range(padding_pages):
+        doc.new_page()  # Shifts the object numbers of the page below
+    page = doc.new_page()
+    state = doc.get_new_xref()
+    doc.update_object(state, f"<</Type/ExtGState/ca {alpha}>>")
+    doc.xref_set_key(page.xref, "Resources", f"<</ExtGState<</G0 {state} 0 R>>>>")
+    contents = doc.get_new_xref()
+    doc.update_object(contents, "<<>>")
+    doc.update_stream(contents, b"/G0 gs 1 0 0 rg 100 100 200 200 re f")
+    doc.xref_set_key(page.xref, "Contents", f"{contents} 0 R")
+    return doc, page
+
+
+def test_page_fingerprint_covers_resources_but_not_object_numbers():
+    _, faint = _graphics_state_page(0.2)
+    _, solid = _graphics_state_page(1.0)
+    _, renumbered = _graphics_state_page(0.2, padding_pages=3)
+    assert page_fingerprint(faint) != page_fingerprint(solid)
+    assert page_fingerprint(faint) == page_fingerprint(renumbered)
+
+
+def _form_page(value):
+    doc = fitz.open()
+    page = doc.new_page()
+    widget = fitz.Widget()
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.field_name = "name"
+    widget.field_value = value
+    widget.rect = fitz.Rect(72, 72, 300, 100)
+    page.add_widget(widget)
+    return doc, page
+
+
+def test_page_fingerprint_skips_form_fields():
+    # Field values are not part of the page, so two filled forms must never share a key
+    _, alice = _form_page("ALICE SMITH")
+    assert page_fingerprint(alice) is None
+
+
+def _record(image_bytes):
+    return (10, 10, [((0, 0, 10, 10), b'x' * image_bytes if image_bytes else None, None)])
+
+
+def test_page_cache_evicts_least_recently_used():
+    entry = PageCache.ENTRY_OVERHEAD + 100
+    cache = PageCache(max_bytes=int(entry * 2.5))
+    cache.put('a', _record(100))
+    cache.put('b', _record(100))
+    assert cache.get('a') is not None  # 'b' is now the oldest
+    cache.put('c', _record(100))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.size <= cache.max_bytes
+    cache.put('huge', _record(cache.max_bytes))
+    assert cache.get('huge') is None and cache.size == 2 * entry
+
+
+def test_page_cache_bounds_records_without_images():
+    cache = PageCache(max_bytes=PageCache.ENTRY_OVERHEAD * 10)
+    for i in range(100):
+        cache.put(i, _record(0))
+    assert len(cache.entries) == 10
+
+
+@pytest.mark.parametrize('budget_mb', [200, 400, 1000, 4000])
+@pytest.mark.parametrize('page_size', [(612, 792), (842, 1191), (2384, 3370)])
+def test_plan_stays_within_memory_budget(budget_mb, page_size):
+    budget = budget_mb * 1024 * 1024
+    governor = ResourceGovernor(budget, cpu_budget=8, max_dpi=300, min_dpi=150)
+    width, height = page_size
+    plan = governor.plan(width, height)
+
+    width_px = width * plan['dpi'] / 72
+    rows = plan['tile_height'] or height * plan['dpi'] / 72
+    fallback = {'dpi': governor.min_dpi, 'tile_height': governor.MIN_TILE_HEIGHT, 'workers': 1}
+    if plan != fallback:
+        assert plan['workers'] * governor.worker_bytes(width_px * rows) <= budget
+    assert governor.min_dpi <= plan['dpi'] <= governor.max_dpi
+    assert 1 <= plan['workers'] <= governor.cpu_budget
+
+
+def test_plan_never_exceeds_max_dpi():
+    # Even the "nothing fits" fallback must respect a max_dpi below min_dpi
+    governor = ResourceGovernor(1024 * 1024, cpu_budget=2, max_dpi=120, min_dpi=150)
+    assert governor.plan(2384, 3370)['dpi'] == 120
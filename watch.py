@@ -0,0 +1,211 @@
+"""
+PDFMute watch-folder mode.
+
+Watches a folder (e.g. where the scanners drop their PDFs) and cleans every
+new or changed PDF into the target folder as soon as it is fully written.
+
+Change detection uses inotify when the optional `inotify_simple` package is
+installed (Linux), and otherwise falls back to polling the folder listing.
+Either way only new or changed files are processed: a PDF is picked up once
+its size and modification time have been stable for `settle_seconds`, and
+skipped if its output is already newer than it. Outputs go through
+main.PdfWriter, which writes a temporary file next to the target and renames
+it into place, so consumers never see a half-written PDF.
+
+Usage:
+  python watch.py exams "no solution" --engine cpu --color white
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+
+from main import ENGINES, warm_up
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+def _pdf_stats(source_dir):
+    """
+    Returns {filename: (size, mtime_ns)} for the PDFs directly inside source_dir.
+    """
+    stats = {}
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith('.pdf') and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def _is_up_to_date(input_path, output_path):
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+
+class FolderWatcher:
+    """
+    Debounces change notifications for source_dir and feeds settled PDFs to a
+    background worker that writes the cleaned copies into target_dir.
+    """
+
+    def __init__(self, source_dir, target_dir, engine='cpu', color='white',
+                 settle_seconds=2.0, poll_interval=1.0, use_inotify=True):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.engine = engine
+        self.color = color
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and INotify is not None
+
+        self.pending = {}      # filename -> (size, mtime_ns, time the stats were last seen changing)
+        self.done = {}         # filename -> (size, mtime_ns) of the version last processed
+        self.work_queue = queue.Queue()
+        self.running = False
+
+    # ------------------- DETECTION ------------------- #
+    def _note_change(self, filename, stats, now):
+        """
+        Records the latest stats of a file; the settle timer restarts whenever they change.
+        """
+        if self.done.get(filename) == stats:
+            return
+        previous = self.pending.get(filename)
+        if previous is None or previous[:2] != stats:
+            self.pending[filename] = (stats[0], stats[1], now)
+
+    def _stat(self, filename):
+        try:
+            stat = os.stat(os.path.join(self.source_dir, filename))
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _collect_settled(self, now):
+        """
+        Moves files whose stats have not changed for settle_seconds onto the work queue.
+        """
+        for filename, (size, mtime_ns, seen_at) in list(self.pending.items()):
+            current = self._stat(filename)
+            if current is None:
+                del self.pending[filename]
+            elif current != (size, mtime_ns):
+                self.pending[filename] = (current[0], current[1], now)
+            elif now - seen_at >= self.settle_seconds and size > 0:
+                del self.pending[filename]
+                self.done[filename] = current
+                self.work_queue.put(filename)
+
+    def _initial_scan(self):
+        """
+        Queues PDFs that arrived while the watcher was not running.
+        """
+        now = time.monotonic()
+        for filename, stats in _pdf_stats(self.source_dir).items():
+            input_path = os.path.join(self.source_dir, filename)
+            if _is_up_to_date(input_path, os.path.join(self.target_dir, filename)):
+                self.done[filename] = stats
+            else:
+                self._note_change(filename, stats, now)
+
+    def _poll_loop(self):
+        while self.running:
+            now = time.monotonic()
+            for filename, stats in _pdf_stats(self.source_dir).items():
+                self._note_change(filename, stats, now)
+            self._collect_settled(now)
+            time.sleep(self.poll_interval)
+
+    def _inotify_loop(self):
+        inotify = INotify()
+        inotify.add_watch(self.source_dir, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+                          | inotify_flags.MODIFY | inotify_flags.CREATE)
+        try:
+            while self.running:
+                # Wakes up on events, or after poll_interval to let pending files settle
+                events = inotify.read(timeout=int(self.poll_interval * 1000))
+                now = time.monotonic()
+                for event in events:
+                    if event.name.lower().endswith('.pdf'):
+                        stats = self._stat(event.name)
+                        if stats is not None:
+                            self._note_change(event.name, stats, now)
+                self._collect_settled(now)
+        finally:
+            inotify.close()
+
+    # ------------------- PROCESSING ------------------- #
+    def _worker(self):
+        while True:
+            filename = self.work_queue.get()
+            if filename is None:
+                break
+            input_path = os.path.join(self.source_dir, filename)
+            output_path = os.path.join(self.target_dir, filename)
+            started = time.perf_counter()
+            try:
+                ENGINES[self.engine](input_path, output_path, None, self.color)
+                print(f"Processed {filename} and saved to {self.target_dir} "
+                      f"({time.perf_counter() - started:.1f}s)")
+            except Exception as e:
+                # Forget it, so the next write to the file retries
+                self.done.pop(filename, None)
+                print(f"Failed to process {filename}: {e}")
+
+    def run(self):
+        """
+        Watches until interrupted (Ctrl+C) or stop() is called from another thread.
+        """
+        if not os.path.exists(self.target_dir):
+            os.makedirs(self.target_dir)  # Create target directory if it doesn't exist
+
+        warm_up((self.engine,))
+        self.running = True
+        worker = threading.Thread(target=self._worker, daemon=True)
+        worker.start()
+
+        mode = "inotify" if self.use_inotify else f"polling every {self.poll_interval}s"
+        print(f"Watching {self.source_dir} ({mode}), writing to {self.target_dir}")
+        try:
+            self._initial_scan()
+            if self.use_inotify:
+                self._inotify_loop()
+            else:
+                self._poll_loop()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.work_queue.put(None)
+            worker.join()
+
+    def stop(self):
+        self.running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean PDFs as they arrive in a folder")
+    parser.add_argument('source_dir')
+    parser.add_argument('target_dir')
+    parser.add_argument('--engine', default='cpu', choices=sorted(ENGINES))
+    parser.add_argument('--color', default='white', choices=['white', 'black'])
+    parser.add_argument('--settle-seconds', type=float, default=2.0,
+                        help="How long a file must stay unchanged before it is processed")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--poll', action='store_true', help="Poll even if inotify is available")
+    args = parser.parse_args()
+
+    FolderWatcher(args.source_dir, args.target_dir, engine=args.engine, color=args.color,
+                  settle_seconds=args.settle_seconds, poll_interval=args.poll_interval,
+                  use_inotify=not args.poll).run()
+
+
+if __name__ == "__main__":
+    main()